@@ -13,7 +13,10 @@ const CONFIG = {
     DEFAULT_TOP_K: 10,
     DEFAULT_SCORE_THRESHOLD: 0.5,
     MAX_CONTEXT_CHARS: 3000,
-    MAX_OUTPUT_TOKENS: 4096 // Increased for longer responses
+    MAX_OUTPUT_TOKENS: 4096, // Increased for longer responses
+    QUERY_EMBEDDING_CACHE_SIZE: 1000, // Query embeddings kept per isolate
+    EMBEDDING_MAX_ATTEMPTS: 3,
+    EMBEDDING_RETRY_BASE_MS: 250
 };
 
 // -------------------------
@@ -32,7 +35,7 @@ When answering, provide comprehensive and detailed responses. Include:
 - References to specific document IDs used
 
 Aim for thorough, informative responses that fully address the user's question.
-`;
+`.trim();
 
 const SYSTEM_PROMPT_HYBRID = `
 You are an assistant that SHOULD PRIORITIZE the provided vector_db tool when answering.
@@ -50,18 +53,43 @@ Guidelines:
 - When using vector_db content, you MUST cite the doc source and doc id(s)
 - If the vector_db is sufficient, do not add external facts unless they are directly relevant
 - Aim for thorough, informative responses that fully address the user's question
-`;
+`.trim();
 
 // -------------------------
 // Vector Search Functions
 // -------------------------
 
+/**
+ * POST with exponential backoff on network errors, rate limiting (429) and transient server errors (5xx)
+ */
+async function fetchWithRetry(url, options, maxAttempts = CONFIG.EMBEDDING_MAX_ATTEMPTS) {
+    for (let attempt = 1; ; attempt++) {
+        let response;
+        try {
+            response = await fetch(url, options);
+        } catch (error) {
+            if (attempt >= maxAttempts) {
+                throw error;
+            }
+        }
+        if (response) {
+            const retryable = response.status === 429 || response.status >= 500;
+            if (!retryable || attempt >= maxAttempts) {
+                return response;
+            }
+            // Release the connection before backing off; the retried body is never read
+            await response.body?.cancel();
+        }
+        await new Promise(resolve => setTimeout(resolve, CONFIG.EMBEDDING_RETRY_BASE_MS * 2 ** (attempt - 1)));
+    }
+}
+
 /**
  * Generate embeddings using Google Gemini API
  */
 async function generateEmbeddings(text, env) {
     try {
-        const response = await fetch(`https://generativelanguage.googleapis.com/v1beta/models/${CONFIG.EMBEDDING_MODEL}:embedContent?key=${env.GOOGLE_API_KEY}`, {
+        const response = await fetchWithRetry(`https://generativelanguage.googleapis.com/v1beta/models/${CONFIG.EMBEDDING_MODEL}:embedContent?key=${env.GOOGLE_API_KEY}`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
@@ -86,15 +114,60 @@ async function generateEmbeddings(text, env) {
 }
 
 /**
- * Search for similar documents in Cloudflare Vectorize
+ * Scale an embedding to unit length (as float32), so the Vectorize dot-product score is the cosine similarity
+ */
+function normalizeEmbedding(values) {
+    const vec = Float32Array.from(values);
+    let sumSquares = 0;
+    for (let i = 0; i < vec.length; i++) {
+        sumSquares += vec[i] * vec[i];
+    }
+    const norm = Math.sqrt(sumSquares);
+    if (norm > 0) {
+        for (let i = 0; i < vec.length; i++) {
+            vec[i] /= norm;
+        }
+    }
+    return vec;
+}
+
+// Query text -> embedding, in insertion order so the first key is the least recently used
+const queryEmbeddingCache = new Map();
+
+/**
+ * Embed a search query, reusing the embedding for repeated queries within this isolate
+ */
+async function getQueryEmbedding(query, env) {
+    const key = query.trim().replace(/\s+/g, ' ');
+
+    const cached = queryEmbeddingCache.get(key);
+    if (cached) {
+        // Refresh recency
+        queryEmbeddingCache.delete(key);
+        queryEmbeddingCache.set(key, cached);
+        return cached;
+    }
+
+    // Stored as float32 (the model's native precision): 3 KB per 768-d vector instead of 6 KB of doubles
+    const values = normalizeEmbedding(await generateEmbeddings(key, env));
+    queryEmbeddingCache.set(key, values);
+    if (queryEmbeddingCache.size > CONFIG.QUERY_EMBEDDING_CACHE_SIZE) {
+        queryEmbeddingCache.delete(queryEmbeddingCache.keys().next().value);
+    }
+    return values;
+}
+
+/**
+ * Search for similar documents in Cloudflare Vectorize.
+ * Optional `filename` restricts the search server-side via the `filename` metadata index.
  */
-async function retrieveDocs(query, topK = CONFIG.DEFAULT_TOP_K, env) {
+async function retrieveDocs(query, topK = CONFIG.DEFAULT_TOP_K, env, filename) {
     try {
         // Generate embeddings for the query
-        const queryEmbeddings = await generateEmbeddings(query, env);
+        const queryEmbeddings = await getQueryEmbedding(query, env);
 
         // Search in Vectorize
-        const vectorQuery = await env.VECTORIZE.query(queryEmbeddings, { topK });
+        const vectorQuery = await env.VECTORIZE.query(queryEmbeddings, filename ? { topK, filter: { filename } } : { topK });
 
         if (!vectorQuery.matches || vectorQuery.matches.length === 0) {
             return [];
@@ -103,17 +176,18 @@ async function retrieveDocs(query, topK = CONFIG.DEFAULT_TOP_K, env) {
         // Get document details from database
         const chunkIds = vectorQuery.matches.map(match => match.id);
         const placeholders = chunkIds.map(() => '?').join(',');
-        const query_sql = `SELECT * FROM pdfs WHERE id IN (${placeholders}) ORDER BY chunk_index ASC`;
+        const query_sql = `SELECT id, text, filename, chunk_index, total_chunks FROM pdfs WHERE id IN (${placeholders})`;
         const { results } = await env.database.prepare(query_sql).bind(...chunkIds).run();
 
         if (!results) {
             return [];
         }
 
-        // Combine vector scores with document data
+        // Combine vector scores with document data (Vectorize already returns matches best-first)
+        const rowsById = new Map(results.map(r => [r.id.toString(), r]));
         const matches = [];
         for (const match of vectorQuery.matches) {
-            const doc = results.find(r => r.id.toString() === match.id);
+            const doc = rowsById.get(match.id);
             if (doc) {
                 matches.push({
                     document: {
@@ -216,9 +290,9 @@ async function callGeminiWithContext(systemPrompt, userQuery, context, env, temp
 /**
  * Database query tool for vector search
  */
-async function dbQueryTool(query, topK = 5, env) {
+async function dbQueryTool(query, topK = 5, env, filename) {
     try {
-        const results = await retrieveDocs(query, topK, env);
+        const results = await retrieveDocs(query, topK, env, filename);
         const formattedResults = results.map(({ document: doc, score }, i) => ({
             doc_id: doc.metadata.id || `unknown_${i}`,
             score: Math.round(score * 1000) / 1000,
@@ -267,10 +341,10 @@ async function googleSearchTool(query, env) {
 /**
  * Simple agent that decides which tools to use
  */
-async function runAgent(query, mode, env) {
+async function runAgent(query, mode, env, filename) {
     try {
         // First, try database search
-        const dbResults = await dbQueryTool(query, 5, env);
+        const dbResults = await dbQueryTool(query, 5, env, filename);
 
         if (mode === "db-only") {
             if (dbResults.length === 0) {
@@ -326,10 +400,10 @@ async function runAgent(query, mode, env) {
 /**
  * Main function to answer queries using RAG
  */
-async function answerQuery(query, mode = "db-only", topK = CONFIG.DEFAULT_TOP_K, scoreThreshold = CONFIG.DEFAULT_SCORE_THRESHOLD, env) {
+async function answerQuery(query, mode = "db-only", topK = CONFIG.DEFAULT_TOP_K, scoreThreshold = CONFIG.DEFAULT_SCORE_THRESHOLD, env, filename) {
     try {
         if (mode === "db-only") {
-            const matches = await retrieveDocs(query, topK, env);
+            const matches = await retrieveDocs(query, topK, env, filename);
 
             if (matches.length === 0) {
                 return { answer: "NOT_IN_DB", provenance: [] };
@@ -348,7 +422,7 @@ async function answerQuery(query, mode = "db-only", topK = CONFIG.DEFAULT_TOP_K,
             return { answer, provenance, raw };
 
         } else if (mode === "hybrid") {
-            const answer = await runAgent(query, mode, env);
+            const answer = await runAgent(query, mode, env, filename);
             return { answer };
 
         } else {
@@ -367,6 +441,8 @@ export {
     answerQuery,
     retrieveDocs,
     generateEmbeddings,
+    getQueryEmbedding,
+    normalizeEmbedding,
     dbQueryTool,
     googleSearchTool,
     buildContextSnippet,
@@ -1,108 +1,503 @@
 # rAG_with_cloudflare_and_gemini.py
-from typing import List
+import asyncio
+import contextlib
+from collections import Counter, deque
+from functools import lru_cache
+from typing import AsyncIterator, List, Optional, Tuple
+import json
+import logging
 import os
+import threading
+import time
+
+import numpy as np
+from cachetools import TTLCache
+
+try:
+    import portalocker  # optional: only needed to persist the semantic cache (SEM_CACHE_DIR)
+except ImportError:
+    portalocker = None
+
+try:
+    import faiss  # optional: ANN probe for large semantic caches
+except ImportError:
+    faiss = None
+
+try:
+    from sentence_transformers import CrossEncoder  # optional: re-rank retrieved chunks
+except ImportError:
+    CrossEncoder = None
 
 # LangChain imports
 from langchain.schema import Document
 from langchain.vectorstores import CloudflareVectorize
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI  # example; replace with your embeddings wrapper if using Cloudflare embeddings
-from langchain.callbacks import get_openai_callback
-from langchain_core.tools import Tool
+from langchain_google_genai import GoogleGenerativeAIEmbeddings  # example; replace with your embeddings wrapper if using Cloudflare embeddings
 from langchain_google_community import GoogleSearchAPIWrapper
-from langcahin.agents import initialize_agent, AgentType
 
 
 # Google GenAI / Gemini
 from google import genai  # per google-genai SDK quickstart
+from google.genai import types
 # If your environment uses different import adjust per SDK docs.
 
 # -------------------------
 # Config / env
 # -------------------------
+logger = logging.getLogger(__name__)
+
 CF_ACCOUNT_ID = os.environ.get("CLOUDFLARE_ACCOUNT_ID")
 CF_API_TOKEN = os.environ.get("CLOUDFLARE_API_TOKEN")
 CF_INDEX_NAME = os.environ.get("CF_INDEX_NAME")   # replace
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 GOOGLE_CSE_ID = os.environ.get("GOOGLE_CSE_ID")
+SEM_CACHE_DIR = os.environ.get("SEM_CACHE_DIR")  # optional: persist the semantic cache across restarts
+SEM_CACHE_MAX_ENTRIES = int(os.environ.get("SEM_CACHE_MAX_ENTRIES", "1000"))
+
+# -------------------------
+# Clients (created on first use, so importing this module makes no network clients)
+# -------------------------
+@lru_cache(maxsize=1)
+def get_client():
+    # Gemini init (google genai)
+    return genai.Client(api_key=GEMINI_API_KEY)
 
-# Gemini init (google genai)
-genai.configure(api_key=GEMINI_API_KEY)
-
-# -------------------------
-# Create vectorstore (LangChain Cloudflare wrapper)
-# -------------------------
-# NOTE: Use the same embedding model used for indexing. Here we show a placeholder embedding class.
-embeddings = GoogleGenerativeAIEmbeddings(model="text-embedding-004")  # <-- Replace with your embedding class if you used Cloudflare embeddings
-
-vectorstore = CloudflareVectorize(
-    account_id=CF_ACCOUNT_ID,
-    api_token=CF_API_TOKEN,
-    index_name=CF_INDEX_NAME,
-    embedding=embeddings
-)
-retriever = vectorstore.as_retriever(search_kwargs={"k": 5})
-# db_tool = Tool(
-#     name="vector_db",
-#     func=lambda q: vectorstore.similarity_search_with_score(q, top_k=5),  # from earlier code
-#     description="Use this to find answers from the private document database."
-# )
-
-def db_query_tool(query: str, top_k: int =5):
-    results  = vectorstore.similarity_search_with_score(query, k=top_k) # [(Document, score)]
-    formatted_results = [{"doc_id": doc.metadata.get("id",f"unknown_{i}"), "score": round(score,3),"source": doc.metadata.get("source","unknown"),"snippet":doc.page_content[:300]+"..."} for i, (doc, score) in enumerate(results, start=1)]
-    return formatted_results
-
-db_tool = Tool(
-    name="vector_db",
-    func=db_query_tool,
-    description=(
-        "Use this tool to search private documents. "
-        "It returns JSON with doc_id, source, score, and snippet. "
-        "When answering, you MUST cite doc_id(s) you used."
+@lru_cache(maxsize=1)
+def get_embeddings():
+    # NOTE: Use the same embedding model used for indexing. Here we show a placeholder embedding class.
+    return GoogleGenerativeAIEmbeddings(model="text-embedding-004")  # <-- Replace with your embedding class if you used Cloudflare embeddings
+
+@lru_cache(maxsize=1)
+def get_vectorstore():
+    # LangChain Cloudflare wrapper
+    return CloudflareVectorize(
+        account_id=CF_ACCOUNT_ID,
+        api_token=CF_API_TOKEN,
+        index_name=CF_INDEX_NAME,
+        embedding=get_embeddings()
     )
-)
 
-search = GoogleSearchAPIWrapper()
-google_tool = Tool(
-    name="google_search",
-    func=search.run,
-    description="Use this to search the web if the private DB does not contain enough info."
-)
+@lru_cache(maxsize=1)
+def get_search():
+    return GoogleSearchAPIWrapper()
+
+# The Gemini and Vectorize async clients keep pooled connections bound to the event loop that
+# first used them, so every coroutine here must run on one loop. The sync entry points submit
+# to a single long-lived background loop instead of calling asyncio.run (a new loop per call);
+# async callers should likewise drive the a* functions from one loop.
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_LOOP_LOCK = threading.Lock()
+
+def _run_sync(coro):
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, name="queryHandling-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _LOOP).result()
+
+_SEARCH_CACHE = TTLCache(maxsize=2048, ttl=1800)  # normalized query -> search.run result
+_SEARCH_CACHE_LOCK = threading.Lock()  # searches run in worker threads; TTLCache is not thread-safe
+
+def cached_search(query: str) -> str:
+    # Custom Search quota is capped per day; identical queries within the TTL reuse the result
+    key = " ".join(query.lower().split())
+    with _SEARCH_CACHE_LOCK:
+        result = _SEARCH_CACHE.get(key)
+    if result is None:
+        result = get_search().run(query)  # not under the lock, so searches still overlap
+        with _SEARCH_CACHE_LOCK:
+            _SEARCH_CACHE[key] = result
+    return result
+
+# -------------------------
+# Query embedding
+# -------------------------
+EMBEDDING_DIM = 768  # text-embedding-004
+
+def embed_query(query: str) -> np.ndarray:
+    """
+    Embed a query and L2-normalize it, so cosine similarity is a plain dot product.
+    Exact repeats (modulo whitespace) are served from an LRU cache; the returned array is read-only.
+    """
+    return _embed_normalized(" ".join(query.split()))
+
+@lru_cache(maxsize=2048)
+def _embed_normalized(query: str) -> np.ndarray:
+    vec = np.asarray(get_embeddings().embed_query(query), dtype=np.float32)
+    vec /= np.linalg.norm(vec)
+    vec.setflags(write=False)
+    return vec
+
+# -------------------------
+# Semantic answer cache
+# -------------------------
+_Q8_SCALE = 127.0
+_PROBE_BLOCK_ROWS = 1024
+ANN_MIN_ENTRIES = 10_000  # caches at least this large probe through FAISS HNSW when available
+HNSW_M = 32
+HNSW_EF_SEARCH = 64
+ANN_CANDIDATES = 8  # neighbours fetched per probe, to step over stale/expired entries
+
+def _quantize(v: np.ndarray) -> np.ndarray:
+    # unit-length float vector -> int8, components in [-127, 127]
+    return np.clip(np.round(np.asarray(v, dtype=np.float32) * _Q8_SCALE), -127, 127).astype(np.int8)
+
+class SemanticCache:
+    """
+    In-process cache of answers keyed by normalized query embedding.
+    A lookup is a single matrix-vector product over all cached queries;
+    paraphrases scoring >= threshold reuse the cached answer.
+    Each entry also records the top retrieval score and top_k it was answered with, so a
+    lookup only matches answers the caller's own score_threshold/top_k would have produced.
+    Entries live in a ring buffer, so when full the oldest one is overwritten.
+    Unit-length vectors are held as int8 (q = round(v * 127)): a quarter of the float32
+    footprint, with a dot-product error well below the gap between threshold and 1.
+
+    For caches of ANN_MIN_ENTRIES or more (and faiss installed) the probe is an HNSW
+    inner-product search instead, which stays fast as the cache grows. This is opt-in:
+    the module cache holds SEM_CACHE_MAX_ENTRIES (default 1000) entries. HNSW cannot delete,
+    so overwritten ring slots linger in the graph as stale ids that lookups skip; the graph
+    is rebuilt from the live rows once stale ids equal the capacity. The rebuild runs in the
+    thread calling put, outside the lock, so concurrent lookups are not held up by it;
+    async callers run put in a worker thread.
+
+    With `path` set, every entry is also appended to `path`/sem_cache.f32 (raw float32 rows)
+    and `path`/records.jsonl (one {row, answer, provenance, ts, ...} line per entry, `row`
+    being the entry's vector row), and a new process starts warm from the newest unexpired
+    entries. Appends are serialized across processes with a lock file (requires portalocker).
+    A process dying mid-append leaves at worst a partial vector row (trimmed by the next
+    append), a vector no record points at, or a torn JSONL line (skipped on load), so
+    records are never paired with the wrong vector. Once the vector log holds more than
+    twice the capacity, both logs are rewritten with only the newest unexpired entries.
+    """
+    def __init__(self, dim: int = EMBEDDING_DIM, threshold: float = 0.92, ttl_seconds: float = 2 * 60 * 60, max_entries: int = 1000, path: Optional[str] = None):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.mat = np.zeros((max_entries, dim), dtype=np.int8)
+        self.ts = np.zeros(max_entries, dtype=np.float64)
+        self.records = [None] * max_entries  # (answer, provenance) per row
+        self.top_scores = np.zeros(max_entries, dtype=np.float32)  # top retrieval score behind each answer
+        self.top_ks = np.zeros(max_entries, dtype=np.int32)
+        self.size = 0
+        self.next = 0
+        self.seq = np.full(max_entries, -1, dtype=np.int64)  # insertion number held by each slot
+        self.inserted = 0
+        self.ann = None
+        self._rebuilding = False
+        self._lock = threading.Lock()  # guards the ring buffer and the ANN index
+        if faiss is not None and max_entries >= ANN_MIN_ENTRIES:
+            self._rebuild_ann()
+        self.path = path
+        if path:
+            if portalocker is None:
+                raise ImportError("persisting the semantic cache requires the portalocker package")
+            os.makedirs(path, exist_ok=True)
+            self._vec_path = os.path.join(path, "sem_cache.f32")
+            self._rec_path = os.path.join(path, "records.jsonl")
+            self._lock_path = os.path.join(path, "sem_cache.lock")
+            self._load()
+
+    def get(self, q: np.ndarray, score_threshold: float = -np.inf, top_k: Optional[int] = None):
+        """
+        Return (answer, provenance) for the closest unexpired query whose answer was
+        retrieved with a top score >= score_threshold (and the same top_k, if given), or None.
+        """
+        with self._lock:
+            if self.size == 0:
+                return None
+            if self.ann is not None:
+                return self._get_ann(q, score_threshold, top_k)
+            return self._get_exact(q, score_threshold, top_k)
+
+    def _get_exact(self, q: np.ndarray, score_threshold: float, top_k: Optional[int]):
+        q8 = _quantize(q).astype(np.int32)
+        # int32 accumulation (int16 would overflow at 768 dims); blocks keep the upcast copy cache-sized
+        scores = np.empty(self.size, dtype=np.float32)
+        for start in range(0, self.size, _PROBE_BLOCK_ROWS):
+            end = min(start + _PROBE_BLOCK_ROWS, self.size)
+            scores[start:end] = self.mat[start:end].astype(np.int32) @ q8
+        scores /= _Q8_SCALE * _Q8_SCALE
+        scores[time.time() - self.ts[:self.size] > self.ttl_seconds] = -np.inf
+        scores[self.top_scores[:self.size] < score_threshold] = -np.inf
+        if top_k is not None:
+            scores[self.top_ks[:self.size] != top_k] = -np.inf
+        i = int(np.argmax(scores))
+        if scores[i] < self.threshold:
+            return None
+        return self.records[i]
+
+    def _get_ann(self, q: np.ndarray, score_threshold: float, top_k: Optional[int]):
+        D, I = self.ann.search(np.asarray(q, dtype=np.float32).reshape(1, -1), ANN_CANDIDATES)
+        now = time.time()
+        for score, id_ in zip(D[0], I[0]):
+            if id_ < 0 or score < self.threshold:
+                break  # results are sorted best-first
+            slot = id_ % self.max_entries
+            if (self.seq[slot] == id_ and now - self.ts[slot] <= self.ttl_seconds
+                    and self.top_scores[slot] >= score_threshold and (top_k is None or self.top_ks[slot] == top_k)):
+                return self.records[slot]
+        return None
+
+    def _rebuild_ann(self):
+        # Fresh graph over the live rows only (dequantized, so it scores like the int8 probe).
+        # Built from a snapshot without holding the lock; rows inserted meanwhile are added before the swap.
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+            vecs = self.mat[:self.size].astype(np.float32) / _Q8_SCALE
+            ids = self.seq[:self.size].copy()
+            built_upto = self.inserted
+        try:
+            hnsw = faiss.IndexHNSWFlat(self.mat.shape[1], HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            hnsw.hnsw.efSearch = HNSW_EF_SEARCH
+            index = faiss.IndexIDMap(hnsw)
+            if len(ids):
+                index.add_with_ids(vecs, ids)
+            with self._lock:
+                fresh = np.flatnonzero(self.seq[:self.size] >= built_upto)
+                if len(fresh):
+                    index.add_with_ids(self.mat[fresh].astype(np.float32) / _Q8_SCALE, self.seq[fresh])
+                self.ann = index
+        finally:
+            self._rebuilding = False
+
+    def put(self, q: np.ndarray, answer, provenance, top_score: float, top_k: int):
+        ts = time.time()
+        self._insert(q, answer, provenance, ts, top_score, top_k)
+        if self.path:
+            with portalocker.Lock(self._lock_path):
+                row = self._append_vector(q)
+                record = {"row": row, "answer": answer, "provenance": provenance, "ts": ts, "top_score": top_score, "top_k": top_k}
+                # a torn last line from a crashed writer must not swallow this record
+                prefix = "" if self._ends_with_newline() else "\n"
+                with open(self._rec_path, "a", encoding="utf-8") as f:
+                    f.write(prefix + json.dumps(record, default=float) + "\n")
+                # Logs are shared by every process, so compact whenever they outgrow the cache
+                if os.path.getsize(self._vec_path) > 2 * self.max_entries * self.mat.shape[1] * 4:
+                    _, vecs, records = self._read_log()
+                    self._compact(vecs, records)
+
+    def _insert(self, q: np.ndarray, answer, provenance, ts: float, top_score: float, top_k: int):
+        q8 = _quantize(q)
+        with self._lock:
+            i = self.next
+            self.mat[i] = q8
+            self.ts[i] = ts
+            self.records[i] = (answer, provenance)
+            self.top_scores[i] = top_score
+            self.top_ks[i] = top_k
+            self.seq[i] = self.inserted
+            self.inserted += 1
+            self.next = (i + 1) % self.max_entries
+            self.size = min(self.size + 1, self.max_entries)
+            rebuild = False
+            if self.ann is not None:
+                self.ann.add_with_ids(self.mat[i:i + 1].astype(np.float32) / _Q8_SCALE, self.seq[i:i + 1])
+                rebuild = self.ann.ntotal >= 2 * self.max_entries
+        if rebuild:
+            self._rebuild_ann()
+
+    def _append_vector(self, q: np.ndarray) -> int:
+        # Append q as the next whole row of the vector log and return its row index
+        # (caller holds the lock); a partial row left by a crashed writer is cut off first
+        row_bytes = self.mat.shape[1] * 4
+        size = os.path.getsize(self._vec_path) if os.path.exists(self._vec_path) else 0
+        if size % row_bytes:
+            os.truncate(self._vec_path, size - size % row_bytes)
+        with open(self._vec_path, "ab") as f:
+            f.write(np.asarray(q, dtype=np.float32).tobytes())
+        return size // row_bytes
+
+    def _ends_with_newline(self) -> bool:
+        # True for a missing or empty records log too
+        if not os.path.exists(self._rec_path) or os.path.getsize(self._rec_path) == 0:
+            return True
+        with open(self._rec_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _load(self):
+        with portalocker.Lock(self._lock_path):
+            n, vecs, records = self._read_log()
+            for v, r in zip(vecs, records):
+                # rows written before top_score/top_k were recorded never match a lookup
+                self._insert(v, r["answer"], r["provenance"], r["ts"], r.get("top_score", -np.inf), r.get("top_k", 0))
+            if n > 2 * self.max_entries:
+                self._compact(vecs, records)
+
+    def _read_log(self):
+        # Newest unexpired rows of the logs, at most max_entries (caller holds the lock)
+        # returns: (rows in the log, float32 vectors, records)
+        dim = self.mat.shape[1]
+        if not (os.path.exists(self._vec_path) and os.path.exists(self._rec_path)):
+            return 0, np.zeros((0, dim), dtype=np.float32), []
+        n_vecs = os.path.getsize(self._vec_path) // (dim * 4)
+        records = []
+        with open(self._rec_path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn write from a crashed process
+                # Each record names its vector row; records from before rows were recorded are dropped
+                if isinstance(r, dict) and isinstance(r.get("row"), int) and 0 <= r["row"] < n_vecs:
+                    records.append(r)
+        n = len(records)
+        if n == 0:
+            return 0, np.zeros((0, dim), dtype=np.float32), []
+        now = time.time()
+        kept = [r for r in records[-self.max_entries:] if now - r["ts"] <= self.ttl_seconds]
+        vecs = np.memmap(self._vec_path, dtype=np.float32, mode="r", shape=(n_vecs, dim))
+        kept_vecs = np.array(vecs[[r["row"] for r in kept]], dtype=np.float32).reshape(-1, dim)  # copy out of the mapping
+        del vecs
+        return n, kept_vecs, kept
+
+    def _compact(self, vecs: np.ndarray, records: List[dict]):
+        # Rewrite both logs with only the rows still in the cache (caller holds the lock)
+        with open(self._vec_path + ".tmp", "wb") as f:
+            f.write(np.ascontiguousarray(vecs, dtype=np.float32).tobytes())
+        with open(self._rec_path + ".tmp", "w", encoding="utf-8") as f:
+            f.writelines(json.dumps({**r, "row": row}, default=float) + "\n" for row, r in enumerate(records))
+        os.replace(self._vec_path + ".tmp", self._vec_path)
+        os.replace(self._rec_path + ".tmp", self._rec_path)
+
+_SEM_CACHE = SemanticCache(max_entries=SEM_CACHE_MAX_ENTRIES, path=SEM_CACHE_DIR)
 
 # -------------------------
 # Retrieval helper
 # -------------------------
-def retrieve_docs(query: str, top_k: int = 8):
+def retrieve_docs(query: str, top_k: int = 8, query_vec: Optional[np.ndarray] = None):
     # returns list of (Document, score)
-    results = vectorstore.similarity_search_with_score(query, k=top_k)
+    # Search by a precomputed vector so the embedding is shared with the semantic cache.
+    # Vectors are unit-length on both sides (ingestion normalizes too), so the index's
+    # dot-product score is the cosine similarity, on the same scale as the cache threshold.
+    if query_vec is None:
+        query_vec = embed_query(query)
+    results = get_vectorstore().similarity_search_by_vector_with_score(query_vec.tolist(), k=top_k)
     # results is list of (Document, score)
     return results
 
+async def aretrieve_docs(query: str, top_k: int = 8, query_vec: Optional[np.ndarray] = None):
+    # async variant of retrieve_docs; the (blocking) embedding call runs in a worker thread
+    if query_vec is None:
+        query_vec = await asyncio.to_thread(embed_query, query)
+    return await get_vectorstore().asimilarity_search_by_vector_with_score(query_vec.tolist(), k=top_k)
+
 # -------------------------
 # Compose context for LLM
 # -------------------------
-def build_context_snippet(matches: List, include_limit_chars=1500):
+CHARS_PER_TOKEN = 4  # rough estimate for English text; avoids a tokenizer round-trip per doc
+CONTEXT_MIN_SCORE = 0.5  # weaker matches are left out of the prompt
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def _match_key(doc) -> object:
+    # metadata id when present, else the chunk's leading text
+    return doc.metadata.get("id") or hash(doc.page_content[:200])
+
+def dedupe_matches(matches: List) -> List:
+    """
+    Collapse matches that point at the same chunk (same metadata id, or the same
+    leading text when there is no id), keeping the highest score of each.
+    returns: list of (doc, score) sorted by score, best first
     """
-    Build a prompt snippet from matches (list of (doc, score))
+    best = {}
+    for doc, score in matches:
+        key = _match_key(doc)
+        if key not in best or best[key][1] < score:
+            best[key] = (doc, score)
+    return sorted(best.values(), key=lambda m: m[1], reverse=True)
+
+def _provenance_entry(doc, score: float) -> dict:
+    return {"id": doc.metadata.get("id"), "score": score, "source": doc.metadata.get("source")}
+
+def match_provenance(matches: List) -> List[dict]:
+    # Provenance for every distinct match, best first; for answers built without a prompt (NOT_IN_DB)
+    return [_provenance_entry(doc, score) for doc, score in dedupe_matches(matches)]
+
+def build_context_snippet(matches: List, token_budget: int = 4096, score_threshold: Optional[float] = None, presorted: bool = False):
+    """
+    Build a prompt snippet from matches (list of (doc, score)), packing the
+    highest-scoring docs first until token_budget is used up.
+    Duplicate chunks are included once; docs scoring below score_threshold (if given) are skipped.
+    With presorted=True, matches are taken as already deduplicated and packed in the given
+    order (e.g. the re-ranker's) rather than by score.
     returns: (context_text, provenance_list)
     """
     parts = []
     provenance = []
-    for i, (doc, score) in enumerate(matches, start=1):
+    remaining = token_budget
+    for doc, score in (matches if presorted else dedupe_matches(matches)):
+        if remaining <= 0:
+            break
+        if score_threshold is not None and score < score_threshold:
+            continue
+        header = f"--- DOC {len(parts) + 1} (id={doc.metadata.get('id','unknown')}, score={score:.4f}) ---\n"
+        body_budget = remaining - estimate_tokens(header)
+        if body_budget <= 0:
+            break
         text = doc.page_content.strip()
-        # truncate to avoid huge prompts
-        if len(text) > include_limit_chars:
-            text = text[:include_limit_chars] + " …"
-        parts.append(f"--- DOC {i} (id={doc.metadata.get('id','unknown')}, score={score:.4f}) ---\n{text}\n")
-        provenance.append({
-            "id": doc.metadata.get("id"),
-            "score": score,
-            "source": doc.metadata.get("source")
-        })
+        # truncate the last doc that fits only partially
+        max_chars = body_budget * CHARS_PER_TOKEN
+        if len(text) > max_chars:
+            text = text[:max_chars] + " …"
+        parts.append(f"{header}{text}\n")
+        remaining -= estimate_tokens(parts[-1])
+        provenance.append(_provenance_entry(doc, score))
     context_text = "\n\n".join(parts)
     return context_text, provenance
 
+# -------------------------
+# Cross-encoder re-rank (optional)
+# -------------------------
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_TOP_N = 3
+RERANK_MAX_CHARS = 512
+_RERANK_CACHE = TTLCache(maxsize=8192, ttl=1800)  # (hash(query), doc key) -> cross-encoder score
+_RERANK_CACHE_LOCK = threading.Lock()  # re-ranking runs in worker threads; TTLCache is not thread-safe
+_RERANKER = None
+_RERANKER_LOCK = threading.Lock()
+
+def get_reranker():
+    # None when sentence-transformers is not installed; callers then keep the vector ranking.
+    # Locked so concurrent first calls load the model once.
+    global _RERANKER
+    if CrossEncoder is None:
+        return None
+    if _RERANKER is None:
+        with _RERANKER_LOCK:
+            if _RERANKER is None:
+                _RERANKER = CrossEncoder(RERANK_MODEL, device="cpu")
+    return _RERANKER
+
+def rerank_matches(query: str, matches: List, top_n: int = RERANK_TOP_N) -> List:
+    """
+    Keep the top_n matches by cross-encoder relevance to the query, so fewer chunks
+    are sent to Gemini. Scores are cached per (query, chunk) across retries.
+    returns: deduplicated list of (doc, vector_score), best first by cross-encoder
+    (by vector score when no re-ranker is available)
+    """
+    reranker = get_reranker()
+    matches = dedupe_matches(matches)
+    if reranker is None or len(matches) <= top_n:
+        return matches
+    qh = hash(query)
+    keys = [(qh, _match_key(doc)) for doc, _ in matches]
+    with _RERANK_CACHE_LOCK:
+        scores = [_RERANK_CACHE.get(k) for k in keys]
+    todo = [j for j, score in enumerate(scores) if score is None]
+    if todo:
+        predicted = reranker.predict([(query, matches[j][0].page_content[:RERANK_MAX_CHARS]) for j in todo])
+        with _RERANK_CACHE_LOCK:
+            for j, score in zip(todo, predicted):
+                scores[j] = _RERANK_CACHE[keys[j]] = float(score)
+    order = sorted(range(len(matches)), key=lambda j: scores[j], reverse=True)
+    return [matches[j] for j in order[:top_n]]
+
 # -------------------------
 # System prompts for the two modes
 # -------------------------
@@ -111,77 +506,351 @@ You are an assistant that MUST ONLY use the provided documents below to answer t
 Do NOT use any external knowledge beyond these documents. If the documents do NOT contain enough
 information to answer the question, reply exactly: "NOT_IN_DB". Provide a short justification
 (one sentence) referencing which documents you used, and include the doc ids used.
-"""
+""".strip()
 
 SYSTEM_PROMPT_HYBRID = """
-You are an assistant that SHOULD PRIORITIZE the provided vector_db tool when answering.
-You MAY use external knowledge and the google_search to help if the vector_db doesn't fully answer the question,
-- Rephrase the user’s query if needed before calling google_search, but give priority to the vector_db results. 
-- When using vector_db content, you MUST cite the doc id(s).
--If the vector_db is sufficient, do not add external facts unless they are directly relevant.
-"""
+You are an assistant that SHOULD PRIORITIZE the provided DATABASE RESULTS when answering.
+You MAY use the WEB SEARCH RESULTS (when present) and external knowledge if the database results don't fully answer the question.
+- When using database content, you MUST cite the doc id(s).
+- If the database results are sufficient, do not add external facts unless they are directly relevant.
+""".strip()
+
+# -------------------------
+# Gemini context cache for system prompts
+# -------------------------
+GEMINI_MODEL = "gemini-2.5-flash"
+PROMPT_CACHE_TTL_SECONDS = 3600
+PROMPT_CACHE_REFRESH_MARGIN_SECONDS = 60
+PROMPT_CACHE_MIN_TOKENS = 1024  # Gemini's minimum cacheable size on 2.5 Flash
+_PROMPT_CACHES = {}  # system prompt -> (cachedContents name or None, expires_at)
+_PROMPT_CACHE_CREATES = {}  # system prompt -> in-flight create task, shared by concurrent callers
+
+async def aget_prompt_cache(system_prompt: str) -> Optional[str]:
+    """
+    Name of a Gemini cachedContents entry holding `system_prompt`, so only the per-query
+    part of each request is prefilled. Created on first use and re-created shortly before
+    its TTL expires. Returns None when caching is unavailable, and callers send the system
+    prompt inline instead: prompts estimated below PROMPT_CACHE_MIN_TOKENS are never sent
+    to the cache API (today's prompts are), and a failed create is logged and not retried for one TTL.
+    """
+    if estimate_tokens(system_prompt) < PROMPT_CACHE_MIN_TOKENS:
+        return None
+    entry = _PROMPT_CACHES.get(system_prompt)
+    if entry is not None and entry[1] - time.time() > PROMPT_CACHE_REFRESH_MARGIN_SECONDS:
+        return entry[0]
+    # Concurrent first (or refresh) calls wait on a single create
+    task = _PROMPT_CACHE_CREATES.get(system_prompt)
+    if task is None:
+        task = asyncio.ensure_future(_acreate_prompt_cache(system_prompt))
+        _PROMPT_CACHE_CREATES[system_prompt] = task
+        task.add_done_callback(lambda _: _PROMPT_CACHE_CREATES.pop(system_prompt, None))
+    return await asyncio.shield(task)
+
+async def _acreate_prompt_cache(system_prompt: str) -> Optional[str]:
+    name = None
+    try:
+        cache = await get_client().aio.caches.create(
+            model=GEMINI_MODEL,
+            config=types.CreateCachedContentConfig(system_instruction=system_prompt, ttl=f"{PROMPT_CACHE_TTL_SECONDS}s")
+        )
+        name = cache.name
+    except Exception:
+        logger.warning("Could not create a Gemini prompt cache; sending the system prompt inline", exc_info=True)
+    _PROMPT_CACHES[system_prompt] = (name, time.time() + PROMPT_CACHE_TTL_SECONDS)
+    return name
 
 # -------------------------
 # Gemini call wrapper
 # -------------------------
-def call_gemini_with_context(system_prompt: str, user_query: str, context: str, temperature=0.0, max_output_tokens=512):
-    # Build prompt payload per Gemini generate API docs
-    prompt = f"{system_prompt}\n\nCONTEXT:\n{context}\n\nUSER QUERY:\n{user_query}\n\nAnswer:"
-    response = genai.generate(
-        model="gemini-2.5-flash",
-        input=prompt,
-        temperature=temperature,
-        max_output_tokens=max_output_tokens
-    )
-    # SDK returns response object — extract text
-    text = response.output[0].content[0].text
-    return text, response
+# Per-request prompt contract: the system prompt travels separately (cached or as
+# system_instruction), so the contents are just the context and the query.
+_PROMPT_PREFIX = "CONTEXT:\n"
+_PROMPT_SUFFIX_TMPL = "\n\nUSER QUERY:\n{query}\n\nAnswer:"
+
+def build_prompt(context: str, user_query: str) -> str:
+    return "".join((_PROMPT_PREFIX, context, _PROMPT_SUFFIX_TMPL.format(query=user_query)))
+
+# Thinking tokens count against max_output_tokens on 2.5 models, so the budget is pinned
+# explicitly. Answers are grounded in the supplied context, so thinking is off by default.
+THINKING_BUDGET = 0
+
+@lru_cache(maxsize=64)
+def _gemini_config(system_prompt: str, cache_name: Optional[str], temperature: float, max_output_tokens: int) -> types.GenerateContentConfig:
+    # Configs only vary by prompt/cache and sampling params, so build each combination once
+    thinking = types.ThinkingConfig(thinking_budget=THINKING_BUDGET)
+    if cache_name:
+        return types.GenerateContentConfig(cached_content=cache_name, temperature=temperature, max_output_tokens=max_output_tokens, thinking_config=thinking)
+    return types.GenerateContentConfig(system_instruction=system_prompt, temperature=temperature, max_output_tokens=max_output_tokens, thinking_config=thinking)
+
+async def _agemini_request(system_prompt: str, user_query: str, context: str, temperature: float, max_output_tokens: int):
+    # Build prompt payload per Gemini generate API docs.
+    # The system prompt is served from the context cache when possible, else sent as system_instruction.
+    cache_name = await aget_prompt_cache(system_prompt)
+    return build_prompt(context, user_query), _gemini_config(system_prompt, cache_name, temperature, max_output_tokens)
+
+# -------------------------
+# Adaptive output-token budget
+# -------------------------
+MAX_OUTPUT_TOKENS = 512 + THINKING_BUDGET  # hard cap on any answer, thinking included
+OUTPUT_TOKEN_HEADROOM = 1.2
+OUTPUT_TOKEN_MIN_SAMPLES = 50  # keep the hard cap until a mode has this many answers
+OUTPUT_TOKEN_WINDOW = 500
+_OUTPUT_TOKENS = {}  # system prompt (one per mode) -> deque of recent output lengths (answer + thinking) in tokens
+OUTPUT_TOKEN_STATS = Counter()  # in-proc counters: "answers", "truncated", "output_tokens"
+
+def max_output_tokens_for(system_prompt: str) -> int:
+    # p95 of recent answer lengths for this mode plus headroom, never above the hard cap
+    samples = _OUTPUT_TOKENS.get(system_prompt)
+    if samples is None or len(samples) < OUTPUT_TOKEN_MIN_SAMPLES:
+        return MAX_OUTPUT_TOKENS
+    p95 = np.percentile(np.fromiter(samples, dtype=np.int32, count=len(samples)), 95)
+    return max(1, min(MAX_OUTPUT_TOKENS, int(p95 * OUTPUT_TOKEN_HEADROOM)))
+
+def is_truncated(response) -> bool:
+    # response: a GenerateContentResponse, or the final chunk of a stream
+    return bool(response.candidates) and response.candidates[0].finish_reason == types.FinishReason.MAX_TOKENS
+
+def is_complete_answer(answer: Optional[str], response) -> bool:
+    # Only complete answers are worth serving again from the semantic cache
+    return bool(answer and answer.strip()) and response is not None and not is_truncated(response)
+
+def record_output_tokens(system_prompt: str, response) -> None:
+    # response: a GenerateContentResponse, or the final chunk of a stream
+    usage = getattr(response, "usage_metadata", None)
+    count = getattr(usage, "candidates_token_count", None)
+    if count is None:
+        return
+    count += getattr(usage, "thoughts_token_count", None) or 0  # thinking also spends max_output_tokens
+    truncated = is_truncated(response)
+    OUTPUT_TOKEN_STATS["answers"] += 1
+    OUTPUT_TOKEN_STATS["output_tokens"] += count
+    if truncated:
+        # a cut-off answer says nothing about its real length; push the budget back up
+        OUTPUT_TOKEN_STATS["truncated"] += 1
+        count = MAX_OUTPUT_TOKENS
+    _OUTPUT_TOKENS.setdefault(system_prompt, deque(maxlen=OUTPUT_TOKEN_WINDOW)).append(count)
+
+async def acall_gemini_with_context(system_prompt: str, user_query: str, context: str, temperature=0.0, max_output_tokens: Optional[int] = None):
+    # async client so concurrent calls overlap; max_output_tokens defaults to the mode's adaptive budget
+    if max_output_tokens is None:
+        max_output_tokens = max_output_tokens_for(system_prompt)
+    prompt, config = await _agemini_request(system_prompt, user_query, context, temperature, max_output_tokens)
+    response = await get_client().aio.models.generate_content(model=GEMINI_MODEL, contents=prompt, config=config)
+    record_output_tokens(system_prompt, response)
+    return response.text, response
+
+async def astream_gemini_with_context(system_prompt: str, user_query: str, context: str, temperature=0.0, max_output_tokens: Optional[int] = None) -> AsyncIterator[types.GenerateContentResponse]:
+    # Yields response chunks as Gemini produces them (chunk.text is the new text), so the first
+    # token arrives long before the full answer; the last chunk carries usage and finish_reason
+    if max_output_tokens is None:
+        max_output_tokens = max_output_tokens_for(system_prompt)
+    prompt, config = await _agemini_request(system_prompt, user_query, context, temperature, max_output_tokens)
+    chunk = None
+    async for chunk in await get_client().aio.models.generate_content_stream(model=GEMINI_MODEL, contents=prompt, config=config):
+        yield chunk
+    if chunk is not None:
+        record_output_tokens(system_prompt, chunk)  # usage is reported on the final chunk
+
+def call_gemini_with_context(system_prompt: str, user_query: str, context: str, temperature=0.0, max_output_tokens: Optional[int] = None):
+    # sync shim for existing callers
+    return _run_sync(acall_gemini_with_context(system_prompt, user_query, context, temperature, max_output_tokens))
 
 # -------------------------
 # The main RAG flow
 # -------------------------
-def answer_query(query: str, mode: str = "db-only", top_k: int = 8, score_threshold=0.72):
+async def _adb_only_retrieve(query: str, q: np.ndarray, top_k: int, score_threshold: float):
+    """
+    DB-only flow up to the score threshold.
+    returns: (result, matches, top_score) where result is a final (answer, info)
+    when no Gemini call is needed, else None.
+    """
+    # Near-paraphrases of a recent query reuse its answer (no Cloudflare or Gemini call)
+    cached = _SEM_CACHE.get(q, score_threshold, top_k)
+    if cached is not None:
+        answer, provenance = cached
+        return (answer, {"provenance": provenance, "cached": True}), None, None
+
+    matches = await aretrieve_docs(query, top_k=top_k, query_vec=q)  # list of (Document, score)
+    if not matches:
+        return ("NOT_IN_DB", {"provenance": []}), None, None
+
+    # check top score
+    top_score = matches[0][1]
+
+    # If top result is below threshold, return NOT_IN_DB (strict behavior)
+    if top_score < score_threshold:
+        return ("NOT_IN_DB", {"provenance": match_provenance(matches)}), None, top_score
+    return None, matches, top_score
+
+async def _adb_only_generate(query: str, q: np.ndarray, matches: List, top_score: float, top_k: int, score_threshold: float,
+                             stream: bool = False, sem: Optional[asyncio.Semaphore] = None):
+    """
+    DB-only flow once the score threshold has passed, shared by the single, streaming and
+    batch paths: re-rank, pack the context, generate, and cache complete answers.
+    yields: ("token", text) pieces when streaming, then ("done", (answer, info))
+    """
+    matches = await asyncio.to_thread(rerank_matches, query, matches)
+    context_text, provenance = build_context_snippet(matches, score_threshold=min(CONTEXT_MIN_SCORE, score_threshold), presorted=True)
+    async with sem or contextlib.nullcontext():
+        if stream:
+            pieces = []
+            raw = None  # last chunk, which carries usage and finish_reason
+            async for raw in astream_gemini_with_context(SYSTEM_PROMPT_DB_ONLY, query, context_text):
+                if raw.text:
+                    pieces.append(raw.text)
+                    yield "token", raw.text
+            answer = "".join(pieces)
+        else:
+            answer, raw = await acall_gemini_with_context(SYSTEM_PROMPT_DB_ONLY, query, context_text)
+    if is_complete_answer(answer, raw):
+        await asyncio.to_thread(_SEM_CACHE.put, q, answer, provenance, top_score, top_k)
+    # If the model returns something other than NOT_IN_DB we accept it (it should rely only on context)
+    yield "done", (answer, {"provenance": provenance, "raw": raw})
+
+async def _adone(events: AsyncIterator[Tuple[str, object]]):
+    # Drain a non-streaming _adb_only_generate and return its final (answer, info)
+    async for _, value in events:
+        pass
+    return value
+
+async def _aanswer_db_only(query: str, q: np.ndarray, top_k: int, score_threshold: float):
+    result, matches, top_score = await _adb_only_retrieve(query, q, top_k, score_threshold)
+    if result is not None:
+        return result
+    return await _adone(_adb_only_generate(query, q, matches, top_score, top_k, score_threshold))
+
+HYBRID_WEB_ONLY_THRESHOLD = 0.5  # below this top score the DB context is dropped
+
+async def _ahybrid_context(query: str, q: np.ndarray, top_k: int, score_threshold: float):
+    # Route on the retrieval score instead of running a tool-selecting agent:
+    #   top >= score_threshold  -> DB context only
+    #   web_floor <= top        -> DB context + one web search
+    #   otherwise               -> web search only
+    # so a request costs one Gemini call plus at most one search call. Capping web_floor
+    # at score_threshold keeps the bands contiguous, so at least one source is always used.
+    matches = await aretrieve_docs(query, top_k=top_k, query_vec=q)
+    top_score = matches[0][1] if matches else 0.0
+    web_floor = min(HYBRID_WEB_ONLY_THRESHOLD, score_threshold)
+
+    parts = []
+    provenance = []
+    if matches and top_score >= web_floor:
+        db_context, provenance = build_context_snippet(
+            await asyncio.to_thread(rerank_matches, query, matches), score_threshold=web_floor, presorted=True
+        )
+        parts.append(f"DATABASE RESULTS:\n{db_context}")
+    if not matches or top_score < score_threshold:
+        web_results = await asyncio.to_thread(cached_search, query)
+        parts.append(f"WEB SEARCH RESULTS:\n{web_results}")
+    return "\n\n".join(parts), provenance
+
+async def _aanswer_hybrid(query: str, q: np.ndarray, top_k: int, score_threshold: float):
+    context_text, provenance = await _ahybrid_context(query, q, top_k, score_threshold)
+    answer, raw = await acall_gemini_with_context(SYSTEM_PROMPT_HYBRID, query, context_text)
+    return answer, {"provenance": provenance, "raw": raw}
+
+async def aanswer_query(query: str, mode: str = "db-only", top_k: int = 8, score_threshold=0.72):
     if mode == "db-only":
-        matches = retrieve_docs(query, top_k=top_k)  # list of (Document, score)
-        if not matches:
-            # if mode == "db-only":
-            return "NOT_IN_DB", {"provenance": []}
-            # else:
-            #     # no matches: still call Gemini with empty context (or with a note)
-            #     context_text = "(no matching documents found in DB)"
-            #     sys_prompt = SYSTEM_PROMPT_HYBRID
-            #     answer, raw = call_gemini_with_context(sys_prompt, query, context_text)
-            #     return answer, {"provenance": []}
-
-        # check top score
-        top_score = matches[0][1]
-        context_text, provenance = build_context_snippet(matches)
-
-        # If top result is below threshold, return NOT_IN_DB (strict behavior)
-        if top_score < score_threshold:
-            return "NOT_IN_DB", {"provenance": provenance}
-        sys_prompt = SYSTEM_PROMPT_DB_ONLY
-        answer, raw = call_gemini_with_context(sys_prompt, query, context_text)
-        # If the model returns something other than NOT_IN_DB we accept it (it should rely only on context)
-        return answer, {"provenance": provenance, "raw": raw}
+        q = await asyncio.to_thread(embed_query, query)
+        return await _aanswer_db_only(query, q, top_k, score_threshold)
 
     elif mode == "hybrid":
-        # Always pass DB context, but allow external knowledge — instruct to prioritize DB
-        # sys_prompt = SYSTEM_PROMPT_HYBRID
-        # answer, raw = call_gemini_with_context(sys_prompt, query, context_text)
-        # return answer, {"provenance": provenance, "raw": raw}
-        llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash")
-
-        tools = [db_tool, google_tool]
-        agent = initialize_agent(
-            tools=tools,
-            llm=llm,
-            agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
-            verbose=True
-        )
-        answer = agent.run(query)
-        return answer
-        
+        q = await asyncio.to_thread(embed_query, query)
+        return await _aanswer_hybrid(query, q, top_k, score_threshold)
 
     else:
         raise ValueError("mode must be 'db-only' or 'hybrid'")
+
+def answer_query(query: str, mode: str = "db-only", top_k: int = 8, score_threshold=0.72):
+    # sync shim for existing callers
+    return _run_sync(aanswer_query(query, mode=mode, top_k=top_k, score_threshold=score_threshold))
+
+async def astream_answer_query(query: str, mode: str = "db-only", top_k: int = 8, score_threshold=0.72) -> AsyncIterator[Tuple[str, object]]:
+    """
+    Streaming variant of aanswer_query: yields ("token", text) as the answer is generated,
+    then ("done", info). Answers that need no generation (cache hit, NOT_IN_DB) arrive as one token.
+    """
+    if mode not in ("db-only", "hybrid"):
+        raise ValueError("mode must be 'db-only' or 'hybrid'")
+    q = await asyncio.to_thread(embed_query, query)
+
+    if mode == "db-only":
+        result, matches, top_score = await _adb_only_retrieve(query, q, top_k, score_threshold)
+        if result is not None:
+            answer, info = result
+            yield "token", answer
+            yield "done", info
+            return
+        async for kind, value in _adb_only_generate(query, q, matches, top_score, top_k, score_threshold, stream=True):
+            yield (kind, value) if kind == "token" else ("done", value[1])
+        return
+
+    context_text, provenance = await _ahybrid_context(query, q, top_k, score_threshold)
+    chunk = None
+    async for chunk in astream_gemini_with_context(SYSTEM_PROMPT_HYBRID, query, context_text):
+        if chunk.text:
+            yield "token", chunk.text
+    yield "done", {"provenance": provenance, "raw": chunk}
+
+# -------------------------
+# Batch RAG flow
+# -------------------------
+MAX_CONCURRENT_REQUESTS = 8  # cap on in-flight Vectorize / Gemini calls per batch
+
+async def _aanswer_queries(queries: List[str], top_k: int, score_threshold: float):
+    # One batched embedding call for all queries, with the same task type embed_query uses,
+    # so batch vectors are comparable with single-query retrieval and the semantic cache
+    vecs = np.asarray(
+        await asyncio.to_thread(get_embeddings().embed_documents, queries, task_type="RETRIEVAL_QUERY"), dtype=np.float32
+    )
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    results = [None] * len(queries)
+
+    misses = []
+    for i, q in enumerate(vecs):
+        cached = _SEM_CACHE.get(q, score_threshold, top_k)
+        if cached is not None:
+            answer, provenance = cached
+            results[i] = (answer, {"provenance": provenance, "cached": True})
+        else:
+            misses.append(i)
+
+    async def retrieve(i):
+        async with sem:
+            return await aretrieve_docs(queries[i], top_k=top_k, query_vec=vecs[i])
+
+    all_matches = await asyncio.gather(*[retrieve(i) for i in misses])
+
+    # Threshold all top scores at once; an empty result counts as -inf
+    top_scores = np.fromiter((m[0][1] if m else -np.inf for m in all_matches), dtype=np.float32, count=len(all_matches))
+    accepted = set(np.flatnonzero(top_scores >= score_threshold).tolist())
+
+    contexts = {}
+    for j, i in enumerate(misses):
+        if not all_matches[j]:
+            results[i] = ("NOT_IN_DB", {"provenance": []})
+            continue
+        if j in accepted:
+            contexts[i] = (all_matches[j], float(top_scores[j]))
+        else:
+            results[i] = ("NOT_IN_DB", {"provenance": match_provenance(all_matches[j])})
+
+    # Only queries that cleared the threshold are re-ranked and sent to Gemini
+    async def generate(i):
+        matches, top_score = contexts[i]
+        results[i] = await _adone(_adb_only_generate(queries[i], vecs[i], matches, top_score, top_k, score_threshold, sem=sem))
+
+    await asyncio.gather(*[generate(i) for i in contexts])
+    return results
+
+def answer_queries(queries: List[str], mode: str = "db-only", top_k: int = 8, score_threshold=0.72):
+    """
+    Answer many questions at once: a single embedding call for the whole batch,
+    then concurrent retrieval and Gemini calls. Returns one (answer, info) per query, in order.
+    """
+    if mode != "db-only":
+        raise ValueError("answer_queries only supports mode 'db-only'")
+    if not queries:
+        return []
+    return _run_sync(_aanswer_queries(queries, top_k, score_threshold))
@@ -13,7 +13,78 @@ import { Hono } from "hono";
 import { cors } from "hono/cors";
 import { WorkflowEntrypoint } from "cloudflare:workers";
 import { GoogleGenerativeAIEmbeddings } from "@langchain/google-genai";
-import { answerQuery } from "../queryHandling.js";
+import { answerQuery, normalizeEmbedding } from "../queryHandling.js";
+
+// Max number of in-flight Gemini embedding requests during ingestion
+const EMBEDDING_CONCURRENCY = 10;
+// Max texts per Gemini batchEmbedContents call
+const EMBEDDING_BATCH_SIZE = 100;
+// Max number of in-flight Gemini table/image extraction requests
+const EXTRACTION_CONCURRENCY = 5;
+// Largest PDF body we are willing to download
+const MAX_PDF_BYTES = 50 * 1024 * 1024;
+// Shared lenient UTF-8 decoder (decode() without { stream: true } keeps no state between calls)
+const utf8Decoder = new TextDecoder('utf-8', { fatal: false });
+// HTML entities decoded in HTML-fallback text, matched in a single pass
+const HTML_ENTITY_RE = /&(nbsp|amp|lt|gt|quot|#39);/g;
+const HTML_ENTITIES = { nbsp: ' ', amp: '&', lt: '<', gt: '>', quot: '"', '#39': "'" };
+// Fixed instructions for image/graph descriptions; only the alt/caption lines vary per call
+const IMAGE_DESCRIPTION_INSTRUCTIONS = [
+  "You are an expert visual describer.",
+  "Given the available alt text and/or caption from a document, generate a concise, informative description of the image/graph.",
+  "Do not hallucinate specifics that are not implied by the text. If information is insufficient, say so succinctly."
+];
+
+// Run `fn` over `items` with at most `limit` promises in flight, preserving input order
+async function mapWithConcurrency(items, limit, fn) {
+  const results = new Array(items.length);
+  let next = 0;
+
+  const worker = async () => {
+    while (next < items.length) {
+      const i = next++;
+      results[i] = await fn(items[i], i);
+    }
+  };
+
+  await Promise.all(Array.from({ length: Math.min(limit, items.length) }, worker));
+  return results;
+}
+
+// Embedding client, created once per isolate and reused across workflow steps
+let embeddingModel = null;
+let embeddingModelApiKey = null;
+
+function getEmbeddingModel(apiKey) {
+  if (!embeddingModel || embeddingModelApiKey !== apiKey) {
+    embeddingModel = new GoogleGenerativeAIEmbeddings({
+      model: "text-embedding-004", // Latest and best Gemini embedding model
+      apiKey,
+    });
+    embeddingModelApiKey = apiKey;
+  }
+  return embeddingModel;
+}
+
+// Pack an embedding as base64 float32 bytes (~4 KB per 768-d vector vs ~15 KB as a JSON number array)
+function encodeEmbedding(values) {
+  const bytes = new Uint8Array(Float32Array.from(values).buffer);
+  let binary = "";
+  for (let i = 0; i < bytes.length; i++) {
+    binary += String.fromCharCode(bytes[i]);
+  }
+  return btoa(binary);
+}
+
+// Inverse of encodeEmbedding
+function decodeEmbedding(encoded) {
+  const binary = atob(encoded);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) {
+    bytes[i] = binary.charCodeAt(i);
+  }
+  return new Float32Array(bytes.buffer);
+}
 
 
 const app = new Hono();
@@ -161,10 +232,11 @@ app.get("/query", async (c) => {
     const mode = c.req.query("mode") || "hybrid"; // "db-only" or "hybrid"
     const topK = parseInt(c.req.query("topK")) || 8;
     const scoreThreshold = parseFloat(c.req.query("scoreThreshold")) || 0.72;
+    const filename = c.req.query("filename"); // optional: restrict search to one document
 
     console.log(`Processing query: "${question}" with mode: ${mode}`);
 
-    const result = await answerQuery(question, mode, topK, scoreThreshold, c.env);
+    const result = await answerQuery(question, mode, topK, scoreThreshold, c.env, filename);
 
     // Format response with sources and doc IDs
     const response = {
@@ -216,23 +288,30 @@ export class RAGWorkflow extends WorkflowEntrypoint {
     while (start < text.length) {
       let end = start + chunkSize;
 
-      // If this isn't the last chunk, try to break at a sentence or word boundary
+      // If this isn't the last chunk, try to break at a sentence or word boundary.
+      // Single backward scan bounded to the tail of the window, instead of three
+      // unbounded lastIndexOf() calls that can walk back to the start of the text.
       if (end < text.length) {
-        // Look for sentence endings within the last 100 characters
-        const sentenceEnd = text.lastIndexOf('.', end);
-        const questionEnd = text.lastIndexOf('?', end);
-        const exclamationEnd = text.lastIndexOf('!', end);
-
-        const lastSentenceEnd = Math.max(sentenceEnd, questionEnd, exclamationEnd);
+        const minSentenceEnd = start + chunkSize * 0.7;
+        const minSpace = start + chunkSize * 0.8;
+        let lastSpace = -1;
+        let lastSentenceEnd = -1;
+
+        for (let i = end; i > minSentenceEnd; i--) {
+          const ch = text[i];
+          if (ch === '.' || ch === '?' || ch === '!') {
+            lastSentenceEnd = i;
+            break;
+          }
+          if (lastSpace === -1 && ch === ' ' && i > minSpace) {
+            lastSpace = i;
+          }
+        }
 
-        if (lastSentenceEnd > start + chunkSize * 0.7) {
+        if (lastSentenceEnd !== -1) {
           end = lastSentenceEnd + 1;
-        } else {
-          // Look for word boundaries
-          const lastSpace = text.lastIndexOf(' ', end);
-          if (lastSpace > start + chunkSize * 0.8) {
-            end = lastSpace;
-          }
+        } else if (lastSpace !== -1) {
+          end = lastSpace;
         }
       }
 
@@ -241,9 +320,11 @@ export class RAGWorkflow extends WorkflowEntrypoint {
         chunks.push(chunk);
       }
 
+      // The tail of the text is covered; further windows would only repeat it
+      if (end >= text.length) break;
+
       // Move start position with overlap
       start = end - overlap;
-      if (start >= text.length) break;
     }
 
     return chunks;
@@ -308,10 +389,45 @@ export class RAGWorkflow extends WorkflowEntrypoint {
     }
   }
 
+  // Stream a response body into a single buffer, rejecting oversize PDFs before buffering them
+  async readBodyWithLimit(response, maxBytes = MAX_PDF_BYTES) {
+    const declaredLength = parseInt(response.headers.get('content-length') || '', 10);
+    if (declaredLength > maxBytes) {
+      throw new Error(`PDF too large: ${declaredLength} bytes (limit ${maxBytes})`);
+    }
+    if (!response.body) {
+      return new ArrayBuffer(0);
+    }
+
+    // Preallocate when the size is known, otherwise grow geometrically
+    let buffer = new Uint8Array(declaredLength > 0 ? declaredLength : 64 * 1024);
+    let length = 0;
+    const reader = response.body.getReader();
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+
+      if (length + value.byteLength > maxBytes) {
+        await reader.cancel();
+        throw new Error(`PDF too large: exceeded ${maxBytes} bytes`);
+      }
+      if (length + value.byteLength > buffer.byteLength) {
+        const grown = new Uint8Array(Math.min(maxBytes, Math.max(buffer.byteLength * 2, length + value.byteLength)));
+        grown.set(buffer.subarray(0, length));
+        buffer = grown;
+      }
+      buffer.set(value, length);
+      length += value.byteLength;
+    }
+
+    return length === buffer.byteLength ? buffer.buffer : buffer.buffer.slice(0, length);
+  }
+
   // Extract text from HTML content (fallback for NCBI viewer pages)
   async extractTextFromHtmlContent(htmlBuffer, filename) {
     try {
-      const htmlContent = new TextDecoder('utf-8', { fatal: false }).decode(htmlBuffer);
+      const htmlContent = utf8Decoder.decode(htmlBuffer);
 
       // Extract text content from HTML
       let extractedText = htmlContent
@@ -322,13 +438,7 @@ export class RAGWorkflow extends WorkflowEntrypoint {
         .trim();
 
       // Clean up common HTML artifacts
-      extractedText = extractedText
-        .replace(/&nbsp;/g, ' ')
-        .replace(/&amp;/g, '&')
-        .replace(/&lt;/g, '<')
-        .replace(/&gt;/g, '>')
-        .replace(/&quot;/g, '"')
-        .replace(/&#39;/g, "'");
+      extractedText = extractedText.replace(HTML_ENTITY_RE, (_, entity) => HTML_ENTITIES[entity]);
 
       const bufferSize = htmlBuffer.byteLength;
       const sizeInMB = (bufferSize / (1024 * 1024)).toFixed(2);
@@ -402,8 +512,7 @@ ${extractedText}`;
 
       // Convert buffer to string for text extraction
       const uint8Array = new Uint8Array(pdfBuffer);
-      const textDecoder = new TextDecoder('utf-8', { fatal: false });
-      const pdfString = textDecoder.decode(uint8Array);
+      const pdfString = utf8Decoder.decode(uint8Array);
 
       let extractedText = '';
 
@@ -575,6 +684,42 @@ ${extractedText}`;
     return tables;
   }
 
+  // Convert a markdown table into a JSON array of row objects keyed by header
+  markdownTableToRows(tableMd) {
+    const splitRow = (line) => line
+      .trim()
+      .replace(/^\|/, "")
+      .replace(/\|$/, "")
+      .split(/(?<!\\)\|/)
+      .map(cell => cell.trim().replace(/\\\|/g, "|"));
+
+    const lines = tableMd.split(/\n/).filter(line => line.trim().length > 0);
+    if (lines.length === 0) return "[]";
+
+    // Line 1 is the separator row (|---|---|). Repeated header names get a numeric
+    // suffix (a, a_2, ...) so no column is overwritten in the row objects.
+    const usedHeaders = new Set();
+    const headers = splitRow(lines[0]).map((h, j) => {
+      const base = h || `column_${j + 1}`;
+      let header = base;
+      for (let n = 2; usedHeaders.has(header); n++) {
+        header = `${base}_${n}`;
+      }
+      usedHeaders.add(header);
+      return header;
+    });
+    const rows = lines.slice(2).map(line => {
+      const cells = splitRow(line);
+      const row = {};
+      headers.forEach((header, j) => {
+        row[header] = cells[j] ?? "";
+      });
+      return row;
+    });
+
+    return JSON.stringify(rows);
+  }
+
   // Extract image references and captions from markdown
   extractImageCaptions(markdown) {
     const images = [];
@@ -614,11 +759,10 @@ ${extractedText}`;
 
           console.log('Response headers:', { contentType, contentDisposition });
 
-          const pdfBuffer = await response.arrayBuffer();
+          const pdfBuffer = await this.readBodyWithLimit(response);
 
           // Check if the content is actually HTML (NCBI viewer page)
-          const textDecoder = new TextDecoder('utf-8', { fatal: false });
-          const contentPreview = textDecoder.decode(pdfBuffer.slice(0, 1000));
+          const contentPreview = utf8Decoder.decode(new Uint8Array(pdfBuffer, 0, Math.min(1000, pdfBuffer.byteLength)));
 
           if (contentPreview.includes('<html') || contentPreview.includes('<!DOCTYPE') ||
             contentType.includes('text/html') || contentPreview.includes('viewport')) {
@@ -630,7 +774,7 @@ ${extractedText}`;
               console.log('Trying actual PDF URL:', actualPdfUrl);
               const actualResponse = await fetch(actualPdfUrl);
               if (actualResponse.ok) {
-                const actualPdfBuffer = await actualResponse.arrayBuffer();
+                const actualPdfBuffer = await this.readBodyWithLimit(actualResponse);
                 const pdfText = await this.extractTextWithCloudflareAI(actualPdfBuffer, filename, env);
                 return pdfText;
               }
@@ -657,151 +801,194 @@ ${extractedText}`;
       await this.ensureAuxTables(env);
     });
 
-    // Use Gemini 1.5 Flash to extract tables as dataframes and image/graph descriptions
-    await step.do("extract tables and images with Gemini", async () => {
+    // Parse markdown tables into dataframes and use Gemini 1.5 Flash for image/graph descriptions.
+    // Not awaited here: it only feeds pdf_tables/pdf_images, so it overlaps the chunk/embed pipeline below
+    // (awaited in the finally block at the end of run()).
+    const tablesAndImages = step.do("extract tables and images with Gemini", async () => {
       try {
         const fname = filename || "untitled";
-        // Tables
         const tableSnippets = this.extractMarkdownTables(extractedText || "");
-        for (let t = 0; t < tableSnippets.length; t++) {
-          const tableMd = tableSnippets[t];
-          const prompt = [
-            "You are a precise data extraction engine.",
-            "Convert the following Markdown table to a compact JSON array of row objects.",
-            "Return ONLY valid JSON. Do not include explanations.",
-            tableMd
-          ];
-          const jsonText = await this.callGeminiFlash(env, prompt);
-          // Insert into D1
-          await env.database
-            .prepare("INSERT INTO pdf_tables (filename, table_index, table_markdown, dataframe_json) VALUES (?, ?, ?, ?)")
-            .bind(fname, t, tableMd, jsonText)
-            .run();
-        }
-
-        // Images and graphs
         const images = this.extractImageCaptions(extractedText || "");
-        for (let i = 0; i < images.length; i++) {
-          const { alt = "", caption = "", url = "" } = images[i];
-          const prompt = [
-            "You are an expert visual describer.",
-            "Given the available alt text and/or caption from a document, generate a concise, informative description of the image/graph.",
-            "Do not hallucinate specifics that are not implied by the text. If information is insufficient, say so succinctly.",
-            `Alt: ${alt || "(none)"}`,
-            `Caption: ${caption || "(none)"}`
-          ];
-          const description = await this.callGeminiFlash(env, prompt);
-          await env.database
-            .prepare("INSERT INTO pdf_images (filename, image_index, alt_text, caption_text, description) VALUES (?, ?, ?, ?, ?)")
-            .bind(fname, i, alt || null, caption || null, description || null)
-            .run();
-        }
-      } catch (e) {
-        console.error("Gemini extraction step failed:", e);
-        // Non-fatal to the overall pipeline
-      }
-    });
+        const descriptionsByText = new Map();
+
+        // Tables are parsed locally; the markdown is already structured, so no LLM call is needed.
+        // They are written in their own batch, overlapping the image calls, so a Gemini failure
+        // can't drop them.
+        const tableStatements = tableSnippets.map((tableMd, t) => env.database
+          .prepare("INSERT INTO pdf_tables (filename, table_index, table_markdown, dataframe_json) VALUES (?, ?, ?, ?)")
+          .bind(fname, t, tableMd, this.markdownTableToRows(tableMd)));
+        const tablesInserted = tableStatements.length > 0
+          ? env.database.batch(tableStatements).catch((e) => console.error("Inserting tables failed:", e))
+          : null;
 
-    // Chunk the extracted text with larger chunks to reduce API calls
-    const chunks = await step.do(`chunk text`, async () => {
-      const filenameToStore = filename || 'untitled';
-      const chunkedData = this.chunkTextWithMetadata(extractedText, filenameToStore, 8000, 500);
-      console.log(`Text chunked into ${chunkedData.length} chunks (8k chunks to minimize API calls)`);
-      return chunkedData;
-    });
-
-    // Create database records for each chunk
-    const records = await step.do(`create database records for chunks`, async () => {
-      try {
-        const records = [];
-        const pdfUrlToStore = pdfUrl || null;
-
-        for (const chunkData of chunks) {
-          const query = "INSERT INTO pdfs (text, filename, pdf_url, chunk_index, total_chunks, chunk_size, original_text_length) VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING *";
-
-          console.log("Inserting chunk into database:", {
-            chunkText: chunkData.text?.substring(0, 100),
-            filename: chunkData.metadata.filename,
-            chunkIndex: chunkData.metadata.chunkIndex,
-            totalChunks: chunkData.metadata.totalChunks
+        try {
+          // Image descriptions need Gemini: run the calls concurrently (bounded)
+          const imageStatements = await mapWithConcurrency(images, EXTRACTION_CONCURRENCY, async ({ alt = "", caption = "", url = "" }, i) => {
+            // Nothing to describe without alt text or a caption; repeated figures (logos, reused
+            // captions) share a single Gemini call
+            let description = null;
+            if (alt || caption) {
+              const key = `${alt}\u0000${caption}`;
+              if (!descriptionsByText.has(key)) {
+                const prompt = [
+                  ...IMAGE_DESCRIPTION_INSTRUCTIONS,
+                  `Alt: ${alt || "(none)"}`,
+                  `Caption: ${caption || "(none)"}`
+                ];
+                // A failed call (429/5xx) only loses this description; the row is still stored
+                descriptionsByText.set(key, this.callGeminiFlash(env, prompt).catch((e) => {
+                  console.error(`Describing image ${i} failed:`, e);
+                  return null;
+                }));
+              }
+              description = await descriptionsByText.get(key);
+            }
+            return env.database
+              .prepare("INSERT INTO pdf_images (filename, image_index, alt_text, caption_text, description) VALUES (?, ?, ?, ?, ?)")
+              .bind(fname, i, alt || null, caption || null, description || null);
           });
 
-          const { results } = await env.database.prepare(query).bind(
-            chunkData.text,
-            chunkData.metadata.filename,
-            pdfUrlToStore,
-            chunkData.metadata.chunkIndex,
-            chunkData.metadata.totalChunks,
-            chunkData.metadata.chunkSize,
-            chunkData.metadata.originalTextLength
-          ).run();
-
-          const record = results[0];
-          if (!record) throw new Error("Failed to create chunk record - no record returned");
-
-          records.push(record);
+          // Insert into D1 in a single round-trip
+          if (imageStatements.length > 0) {
+            await env.database.batch(imageStatements);
+          }
+        } finally {
+          await tablesInserted;
         }
-
-        console.log(`Created ${records.length} database records for chunks`);
-        return records;
-      } catch (error) {
-        console.error("Database insertion error:", error);
-        throw error;
+      } catch (e) {
+        console.error("Gemini extraction step failed:", e);
+        // Non-fatal to the overall pipeline
       }
     });
 
-    // Generate embeddings for each chunk
-    const embeddings = await step.do(`generate embeddings for chunks`, async () => {
-      try {
-        console.log(`Generating embeddings for ${chunks.length} chunks`);
-
-        // Use LangChain with Gemini embeddings for ingestion
-        const embeddingModel = new GoogleGenerativeAIEmbeddings({
-          model: "text-embedding-004", // Latest and best Gemini embedding model
-          apiKey: env.GOOGLE_API_KEY,
-        });
-
-        const chunkEmbeddings = [];
-
-        for (let i = 0; i < chunks.length; i++) {
-          const chunk = chunks[i];
-          console.log(`Generating embedding for chunk ${i + 1}/${chunks.length}:`, chunk.text?.substring(0, 100));
+    // Await tablesAndImages even if one of these steps throws, so no step is left dangling
+    try {
+      // Chunk the extracted text with larger chunks to reduce API calls
+      const chunks = await step.do(`chunk text`, async () => {
+        const filenameToStore = filename || 'untitled';
+        const chunkedData = this.chunkTextWithMetadata(extractedText, filenameToStore, 8000, 500);
+        console.log(`Text chunked into ${chunkedData.length} chunks (8k chunks to minimize API calls)`);
+        return chunkedData;
+      });
+
+      // Create database records and generate embeddings concurrently: embeddings only need the
+      // chunk text, and are paired with record ids by position when the vectors are inserted.
+      // allSettled so a failure in one step doesn't leave the other running un-awaited
+      const settled = await Promise.allSettled([
+        step.do(`create database records for chunks`, async () => {
+          try {
+            const pdfUrlToStore = pdfUrl || null;
+            // Only the generated id is needed downstream (as the vector id); keep the persisted step result small
+            const query = "INSERT INTO pdfs (text, filename, pdf_url, chunk_index, total_chunks, chunk_size, original_text_length) VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id";
+
+            console.log(`Inserting ${chunks.length} chunks into database`);
+
+            // One D1 round-trip for all chunks instead of one per chunk
+            const statements = chunks.map(chunkData => env.database.prepare(query).bind(
+              chunkData.text,
+              chunkData.metadata.filename,
+              pdfUrlToStore,
+              chunkData.metadata.chunkIndex,
+              chunkData.metadata.totalChunks,
+              chunkData.metadata.chunkSize,
+              chunkData.metadata.originalTextLength
+            ));
+            const batchResults = statements.length > 0 ? await env.database.batch(statements) : [];
+
+            const records = batchResults.map(({ results }) => {
+              const record = results?.[0];
+              if (!record) throw new Error("Failed to create chunk record - no record returned");
+              return record;
+            });
+
+            console.log(`Created ${records.length} database records for chunks`);
+            return records;
+          } catch (error) {
+            console.error("Database insertion error:", error);
+            throw error;
+          }
+        }),
+
+        // Generate embeddings for each chunk
+        step.do(`generate embeddings for chunks`, async () => {
+          try {
+            console.log(`Generating embeddings for ${chunks.length} chunks`);
+
+            // Use LangChain with Gemini embeddings for ingestion
+            const embeddingModel = getEmbeddingModel(env.GOOGLE_API_KEY);
+
+            // Identical chunks (repeated headers/boilerplate) are embedded once and scattered back
+            const uniqueTexts = [];
+            const uniqueIndexByText = new Map();
+            const uniqueIndexOfChunk = chunks.map(chunk => {
+              let u = uniqueIndexByText.get(chunk.text);
+              if (u === undefined) {
+                u = uniqueTexts.length;
+                uniqueIndexByText.set(chunk.text, u);
+                uniqueTexts.push(chunk.text);
+              }
+              return u;
+            });
+            if (uniqueTexts.length < chunks.length) {
+              console.log(`Skipping ${chunks.length - uniqueTexts.length} duplicate chunks`);
+            }
 
-          // Generate embeddings for each chunk
-          const values = await embeddingModel.embedQuery(chunk.text);
-          if (!values) throw new Error(`Failed to generate vector embedding for chunk ${i + 1}`);
+            // Embed unique texts in batches (one batchEmbedContents call per slice), batches run concurrently
+            const batches = [];
+            for (let start = 0; start < uniqueTexts.length; start += EMBEDDING_BATCH_SIZE) {
+              batches.push(uniqueTexts.slice(start, start + EMBEDDING_BATCH_SIZE));
+            }
 
-          chunkEmbeddings.push({
+            const batchValues = await mapWithConcurrency(batches, EMBEDDING_CONCURRENCY, async (texts, b) => {
+              console.log(`Generating embeddings for batch ${b + 1}/${batches.length} (${texts.length} chunks)`);
+              return await embeddingModel.embedDocuments(texts);
+            });
+            const uniqueValues = batchValues.flat();
+
+            const chunkEmbeddings = chunks.map((chunk, i) => {
+              const values = uniqueValues[uniqueIndexOfChunk[i]];
+              if (!values || values.length === 0) throw new Error(`Failed to generate vector embedding for chunk ${i + 1}`);
+
+              return {
+                dimensions: values.length,
+                values: encodeEmbedding(normalizeEmbedding(values)),
+                chunkIndex: chunk.metadata.chunkIndex,
+                filename: chunk.metadata.filename
+              };
+            });
+
+            console.log(`Embeddings generated successfully for ${chunkEmbeddings.length} chunks, dimensions:`, chunkEmbeddings[0]?.dimensions);
+            // Step results are persisted by Workflows; keep them compact
+            return chunkEmbeddings;
+          } catch (error) {
+            console.error("Embedding generation error:", error);
+            throw error;
+          }
+        })
+      ]);
+      const failed = settled.find(({ status }) => status === "rejected");
+      if (failed) throw failed.reason;
+      const [records, embeddings] = settled.map(({ value }) => value);
+
+      // Insert vectors for all chunks
+      await step.do(`insert vectors for all chunks`, async () => {
+        try {
+          const vectorData = embeddings.map((embedding, i) => ({
             id: records[i].id.toString(),
-            values: values,
-            chunkIndex: chunk.metadata.chunkIndex,
-            filename: chunk.metadata.filename
-          });
-        }
+            values: decodeEmbedding(embedding.values),
+            metadata: { filename: embedding.filename },
+          }));
 
-        console.log(`Embeddings generated successfully for ${chunkEmbeddings.length} chunks, dimensions:`, chunkEmbeddings[0]?.values.length);
-        return chunkEmbeddings;
-      } catch (error) {
-        console.error("Embedding generation error:", error);
-        throw error;
-      }
-    });
-
-    // Insert vectors for all chunks
-    await step.do(`insert vectors for all chunks`, async () => {
-      try {
-        const vectorData = embeddings.map(embedding => ({
-          id: embedding.id,
-          values: embedding.values,
-        }));
-
-        console.log(`Inserting ${vectorData.length} vectors into Vectorize`);
-        return await env.VECTORIZE.upsert(vectorData);
-      } catch (error) {
-        console.error("Vector insertion error:", error);
-        throw error;
-      }
-    });
+          console.log(`Inserting ${vectorData.length} vectors into Vectorize`);
+          return await env.VECTORIZE.upsert(vectorData);
+        } catch (error) {
+          console.error("Vector insertion error:", error);
+          throw error;
+        }
+      });
+    } finally {
+      await tablesAndImages;
+    }
   }
 }
 
@@ -0,0 +1,49 @@
+# pytest setup for queryHandling.py: the LangChain / google-genai clients it imports are
+# stubbed when not installed, so the local logic can be tested without network access.
+import importlib
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _stub_module(name: str, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+class _Stub:
+    # Stand-in for client and config classes: keeps its keyword arguments as attributes
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _ensure(name: str, **attrs):
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        parent = name.rpartition(".")[0]
+        if parent and parent not in sys.modules:
+            _ensure(parent)
+        _stub_module(name, **attrs)
+
+
+_ensure("langchain.schema", Document=_Stub)
+_ensure("langchain.vectorstores", CloudflareVectorize=_Stub)
+_ensure("langchain_google_genai", GoogleGenerativeAIEmbeddings=_Stub)
+_ensure("langchain_google_community", GoogleSearchAPIWrapper=_Stub)
+_ensure("google.genai", Client=_Stub)
+_ensure(
+    "google.genai.types",
+    GenerateContentConfig=_Stub,
+    GenerateContentResponse=_Stub,
+    ThinkingConfig=_Stub,
+    CreateCachedContentConfig=_Stub,
+    FinishReason=types.SimpleNamespace(STOP="STOP", MAX_TOKENS="MAX_TOKENS"),
+)
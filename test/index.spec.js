@@ -1,6 +1,6 @@
 import { env, createExecutionContext, waitOnExecutionContext, SELF } from 'cloudflare:test';
 import { describe, it, expect } from 'vitest';
-import worker from '../src';
+import worker, { RAGWorkflow } from '../src';
 
 describe('RAG AI Tutorial worker', () => {
 	it('responds to questions (unit style)', async () => {
@@ -77,3 +77,60 @@ describe('RAG AI Tutorial worker', () => {
 		expect(await response.text()).toBe('Missing filename for PDF');
 	});
 });
+
+describe('RAGWorkflow ingestion helpers', () => {
+	// The helpers don't touch workflow state, so no Workflows runtime is needed
+	const workflow = Object.create(RAGWorkflow.prototype);
+
+	it('parses markdown tables into row objects', () => {
+		const table = '| name | value |\n|---|---|\n| a \\| b | 1 |\n| c | 2 |';
+		expect(JSON.parse(workflow.markdownTableToRows(table))).toEqual([
+			{ name: 'a | b', value: '1' },
+			{ name: 'c', value: '2' },
+		]);
+	});
+
+	it('pads short rows and drops extra cells in ragged tables', () => {
+		const table = '| a | b |\n|---|---|\n| 1 |\n| 2 | 3 | 4 |';
+		expect(JSON.parse(workflow.markdownTableToRows(table))).toEqual([
+			{ a: '1', b: '' },
+			{ a: '2', b: '3' },
+		]);
+	});
+
+	it('keeps every column when header names repeat', () => {
+		const table = '| a | a | a_2 | |\n|---|---|---|---|\n| 1 | 2 | 3 | 4 |';
+		expect(JSON.parse(workflow.markdownTableToRows(table))).toEqual([
+			{ a: '1', a_2: '2', a_2_2: '3', column_4: '4' },
+		]);
+	});
+
+	it('stops chunking once the tail of the text is covered', () => {
+		const text = 'x'.repeat(2500);
+		const chunks = workflow.chunkText(text, 1000, 200);
+		expect(chunks.map(chunk => chunk.length)).toEqual([1000, 1000, 900]);
+		expect(chunks.join('').length).toBe(text.length + 2 * 200);
+	});
+
+	it('reads bodies within the size limit', async () => {
+		const bytes = new Uint8Array([1, 2, 3, 4]);
+		const buffer = await workflow.readBodyWithLimit(new Response(bytes), 10);
+		expect(new Uint8Array(buffer)).toEqual(bytes);
+	});
+
+	it('rejects bodies whose declared length exceeds the limit', async () => {
+		const response = new Response('x'.repeat(20), { headers: { 'content-length': '20' } });
+		await expect(workflow.readBodyWithLimit(response, 10)).rejects.toThrow('PDF too large');
+	});
+
+	it('rejects streamed bodies that grow past the limit', async () => {
+		const body = new ReadableStream({
+			start(controller) {
+				controller.enqueue(new Uint8Array(8));
+				controller.enqueue(new Uint8Array(8));
+				controller.close();
+			},
+		});
+		await expect(workflow.readBodyWithLimit(new Response(body), 10)).rejects.toThrow('PDF too large');
+	});
+});
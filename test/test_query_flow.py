@@ -0,0 +1,180 @@
+import asyncio
+import types
+
+import numpy as np
+import pytest
+
+import queryHandling as qh
+
+
+class Doc:
+    def __init__(self, id_, text="text", source="src"):
+        self.metadata = {"id": id_, "source": source}
+        self.page_content = text
+
+
+def response(tokens=10, thoughts=0, finish_reason="STOP", text="answer"):
+    return types.SimpleNamespace(
+        text=text,
+        usage_metadata=types.SimpleNamespace(candidates_token_count=tokens, thoughts_token_count=thoughts),
+        candidates=[types.SimpleNamespace(finish_reason=getattr(qh.types.FinishReason, finish_reason))],
+    )
+
+
+@pytest.fixture(autouse=True)
+def no_reranker(monkeypatch):
+    monkeypatch.setattr(qh, "get_reranker", lambda: None)
+
+
+# -------------------------
+# Context packing
+# -------------------------
+def test_dedupe_keeps_the_best_score_of_each_chunk():
+    a, b = Doc("a"), Doc("b")
+    deduped = qh.dedupe_matches([(a, 0.5), (b, 0.7), (a, 0.9)])
+    assert [(d.metadata["id"], s) for d, s in deduped] == [("a", 0.9), ("b", 0.7)]
+
+
+def test_dedupe_falls_back_to_the_leading_text_without_an_id():
+    a, b = Doc(None, "same text"), Doc(None, "same text")
+    assert len(qh.dedupe_matches([(a, 0.5), (b, 0.6)])) == 1
+
+
+def test_context_packs_best_first_and_truncates_at_the_budget():
+    matches = [(Doc("low", "y" * 4000), 0.6), (Doc("high", "x" * 4000), 0.9)]
+    context, provenance = qh.build_context_snippet(matches, token_budget=1200)
+
+    assert [p["id"] for p in provenance] == ["high", "low"]
+    assert context.index("id=high") < context.index("id=low")
+    assert qh.estimate_tokens(context) <= 1200 + 2
+    assert context.rstrip().endswith("…")
+
+
+def test_context_skips_docs_below_the_score_threshold():
+    matches = [(Doc("a"), 0.9), (Doc("b"), 0.3)]
+    _, provenance = qh.build_context_snippet(matches, score_threshold=0.5)
+    assert [p["id"] for p in provenance] == ["a"]
+
+
+def test_presorted_context_keeps_the_given_order():
+    matches = [(Doc("a"), 0.6), (Doc("b"), 0.9)]
+    _, provenance = qh.build_context_snippet(matches, presorted=True)
+    assert [p["id"] for p in provenance] == ["a", "b"]
+
+
+def test_match_provenance_reports_every_distinct_match():
+    matches = [(Doc(str(i), "x" * 8000), 0.9 - i / 100) for i in range(8)] + [(Doc("0"), 0.1)]
+    assert [p["id"] for p in qh.match_provenance(matches)] == [str(i) for i in range(8)]
+
+
+# -------------------------
+# Hybrid routing
+# -------------------------
+@pytest.mark.parametrize("score_threshold, top_score, expect_db, expect_web", [
+    (0.72, 0.80, True, False),   # DB only
+    (0.72, 0.60, True, True),    # DB + web
+    (0.72, 0.30, False, True),   # web only
+    (0.40, 0.45, True, False),   # threshold below HYBRID_WEB_ONLY_THRESHOLD
+    (0.40, 0.30, False, True),
+])
+def test_hybrid_routing_bands(monkeypatch, score_threshold, top_score, expect_db, expect_web):
+    async def fake_retrieve(query, top_k=8, query_vec=None):
+        return [(Doc("a"), top_score)]
+
+    monkeypatch.setattr(qh, "aretrieve_docs", fake_retrieve)
+    monkeypatch.setattr(qh, "cached_search", lambda query: "web says hi")
+
+    context, _ = asyncio.run(qh._ahybrid_context("q", None, 8, score_threshold))
+    assert ("DATABASE RESULTS" in context) == expect_db
+    assert ("WEB SEARCH RESULTS" in context) == expect_web
+
+
+def test_hybrid_without_matches_searches_the_web(monkeypatch):
+    async def fake_retrieve(query, top_k=8, query_vec=None):
+        return []
+
+    monkeypatch.setattr(qh, "aretrieve_docs", fake_retrieve)
+    monkeypatch.setattr(qh, "cached_search", lambda query: "web says hi")
+
+    context, provenance = asyncio.run(qh._ahybrid_context("q", None, 8, 0.0))
+    assert context == "WEB SEARCH RESULTS:\nweb says hi"
+    assert provenance == []
+
+
+# -------------------------
+# Adaptive output-token budget
+# -------------------------
+def test_output_budget_tracks_p95_including_thinking(monkeypatch):
+    monkeypatch.setattr(qh, "_OUTPUT_TOKENS", {})
+    prompt = "mode"
+    assert qh.max_output_tokens_for(prompt) == qh.MAX_OUTPUT_TOKENS
+
+    for _ in range(qh.OUTPUT_TOKEN_MIN_SAMPLES):
+        qh.record_output_tokens(prompt, response(tokens=80, thoughts=20))
+    assert qh.max_output_tokens_for(prompt) == int(100 * qh.OUTPUT_TOKEN_HEADROOM)
+
+
+def test_truncated_answers_push_the_budget_back_to_the_cap(monkeypatch):
+    monkeypatch.setattr(qh, "_OUTPUT_TOKENS", {})
+    prompt = "mode"
+    for _ in range(qh.OUTPUT_TOKEN_MIN_SAMPLES):
+        qh.record_output_tokens(prompt, response(tokens=50, finish_reason="MAX_TOKENS"))
+    assert qh.max_output_tokens_for(prompt) == qh.MAX_OUTPUT_TOKENS
+
+
+def test_only_complete_answers_are_cacheable():
+    assert qh.is_complete_answer("answer", response())
+    assert not qh.is_complete_answer("", response())
+    assert not qh.is_complete_answer("answer", response(finish_reason="MAX_TOKENS"))
+
+
+# -------------------------
+# DB-only flow
+# -------------------------
+@pytest.fixture
+def db_only(monkeypatch):
+    calls = {"retrieve": 0, "gemini": 0}
+    state = {"matches": [(Doc("a"), 0.9), (Doc("b"), 0.8)], "response": response()}
+
+    async def fake_retrieve(query, top_k=8, query_vec=None):
+        calls["retrieve"] += 1
+        return state["matches"]
+
+    async def fake_gemini(system_prompt, user_query, context, temperature=0.0, max_output_tokens=None):
+        calls["gemini"] += 1
+        return state["response"].text, state["response"]
+
+    monkeypatch.setattr(qh, "aretrieve_docs", fake_retrieve)
+    monkeypatch.setattr(qh, "acall_gemini_with_context", fake_gemini)
+    monkeypatch.setattr(qh, "_SEM_CACHE", qh.SemanticCache(max_entries=10))
+    q = np.zeros(qh.EMBEDDING_DIM, dtype=np.float32)
+    q[0] = 1.0
+    return calls, state, q
+
+
+def test_db_only_answers_are_cached(db_only):
+    calls, _, q = db_only
+    answer, info = asyncio.run(qh._aanswer_db_only("q", q, 8, 0.72))
+    assert answer == "answer"
+    assert [p["id"] for p in info["provenance"]] == ["a", "b"]
+
+    answer, info = asyncio.run(qh._aanswer_db_only("q", q, 8, 0.72))
+    assert answer == "answer" and info["cached"]
+    assert calls == {"retrieve": 1, "gemini": 1}
+
+
+def test_db_only_does_not_cache_truncated_answers(db_only):
+    calls, state, q = db_only
+    state["response"] = response(finish_reason="MAX_TOKENS")
+    asyncio.run(qh._aanswer_db_only("q", q, 8, 0.72))
+    asyncio.run(qh._aanswer_db_only("q", q, 8, 0.72))
+    assert calls["gemini"] == 2
+
+
+def test_db_only_below_threshold_is_not_in_db_with_full_provenance(db_only):
+    calls, state, q = db_only
+    state["matches"] = [(Doc(str(i), "x" * 8000), 0.6) for i in range(8)]
+    answer, info = asyncio.run(qh._aanswer_db_only("q", q, 8, 0.72))
+    assert answer == "NOT_IN_DB"
+    assert len(info["provenance"]) == 8
+    assert calls["gemini"] == 0
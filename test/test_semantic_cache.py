@@ -0,0 +1,164 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import queryHandling as qh
+
+DIM = qh.EMBEDDING_DIM
+
+
+def unit(seed: int) -> np.ndarray:
+    v = np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+    return v / np.linalg.norm(v)
+
+
+def put(cache, v, answer, top_score=0.9, top_k=8):
+    cache.put(v, answer, [], top_score, top_k)
+
+
+# -------------------------
+# Persistence
+# -------------------------
+def test_persisted_entries_warm_a_new_cache(tmp_path):
+    a, b = unit(1), unit(2)
+    cache = qh.SemanticCache(path=str(tmp_path), max_entries=10)
+    put(cache, a, "answer-for-A")
+    put(cache, b, "answer-for-B")
+
+    reloaded = qh.SemanticCache(path=str(tmp_path), max_entries=10)
+    assert reloaded.get(a) == ("answer-for-A", [])
+    assert reloaded.get(b) == ("answer-for-B", [])
+
+
+def test_logs_are_compacted_once_they_outgrow_the_cache(tmp_path):
+    cache = qh.SemanticCache(path=str(tmp_path), max_entries=5)
+    vecs = [unit(i) for i in range(30)]
+    for i, v in enumerate(vecs):
+        put(cache, v, f"answer-{i}")
+
+    assert os.path.getsize(tmp_path / "sem_cache.f32") <= 2 * 5 * DIM * 4
+    reloaded = qh.SemanticCache(path=str(tmp_path), max_entries=5)
+    assert reloaded.get(vecs[-1]) == ("answer-29", [])
+    assert reloaded.get(vecs[0]) is None
+
+
+def test_orphan_vector_from_a_crash_does_not_shift_later_records(tmp_path):
+    a, b = unit(1), unit(2)
+    cache = qh.SemanticCache(path=str(tmp_path), max_entries=10)
+    # A writer died after appending its vector but before appending the record
+    with open(tmp_path / "sem_cache.f32", "ab") as f:
+        f.write(a.tobytes())
+    put(cache, b, "answer-for-B")
+
+    reloaded = qh.SemanticCache(path=str(tmp_path), max_entries=10)
+    assert reloaded.get(a) is None
+    assert reloaded.get(b) == ("answer-for-B", [])
+
+
+def test_torn_record_line_does_not_swallow_later_records(tmp_path):
+    a, b = unit(1), unit(2)
+    cache = qh.SemanticCache(path=str(tmp_path), max_entries=10)
+    put(cache, a, "answer-for-A")
+    # A writer died halfway through its record line
+    with open(tmp_path / "sem_cache.f32", "ab") as f:
+        f.write(unit(3).tobytes())
+    with open(tmp_path / "records.jsonl", "a", encoding="utf-8") as f:
+        f.write('{"row": 1, "answer": "tor')
+    put(cache, b, "answer-for-B")
+
+    reloaded = qh.SemanticCache(path=str(tmp_path), max_entries=10)
+    assert reloaded.get(a) == ("answer-for-A", [])
+    assert reloaded.get(b) == ("answer-for-B", [])
+    assert reloaded.get(unit(3)) is None
+
+
+def test_partial_vector_row_is_trimmed_before_the_next_append(tmp_path):
+    a, b = unit(1), unit(2)
+    cache = qh.SemanticCache(path=str(tmp_path), max_entries=10)
+    put(cache, a, "answer-for-A")
+    with open(tmp_path / "sem_cache.f32", "ab") as f:
+        f.write(unit(3).tobytes()[:100])
+    put(cache, b, "answer-for-B")
+
+    assert os.path.getsize(tmp_path / "sem_cache.f32") == 2 * DIM * 4
+    reloaded = qh.SemanticCache(path=str(tmp_path), max_entries=10)
+    assert reloaded.get(b) == ("answer-for-B", [])
+
+
+def test_records_without_a_row_are_ignored(tmp_path):
+    # Logs written before records named their vector row cannot be paired safely
+    with open(tmp_path / "sem_cache.f32", "wb") as f:
+        f.write(unit(1).tobytes())
+    with open(tmp_path / "records.jsonl", "w", encoding="utf-8") as f:
+        f.write(json.dumps({"answer": "old", "provenance": [], "ts": 0}) + "\n")
+
+    cache = qh.SemanticCache(path=str(tmp_path), max_entries=10)
+    assert cache.size == 0
+
+
+def test_persistence_requires_portalocker(tmp_path, monkeypatch):
+    monkeypatch.setattr(qh, "portalocker", None)
+    with pytest.raises(ImportError):
+        qh.SemanticCache(path=str(tmp_path))
+
+
+# -------------------------
+# Lookups
+# -------------------------
+def test_int8_probe_hits_near_paraphrases_only():
+    cache = qh.SemanticCache(max_entries=10)
+    v = unit(1)
+    put(cache, v, "answer")
+
+    nudged = v + 0.05 * unit(2)
+    nudged /= np.linalg.norm(nudged)
+    assert cache.get(nudged) == ("answer", [])
+    assert cache.get(unit(3)) is None
+
+
+def test_expired_entries_are_not_served():
+    cache = qh.SemanticCache(max_entries=10, ttl_seconds=60)
+    v = unit(1)
+    cache._insert(v, "stale", [], qh.time.time() - 120, 0.9, 8)
+    assert cache.get(v) is None
+
+
+def test_hits_respect_the_callers_score_threshold_and_top_k():
+    cache = qh.SemanticCache(max_entries=10)
+    v = unit(1)
+    put(cache, v, "answer", top_score=0.8, top_k=8)
+
+    assert cache.get(v, 0.72, 8) == ("answer", [])
+    assert cache.get(v, 0.85, 8) is None
+    assert cache.get(v, 0.72, 5) is None
+
+
+def test_ring_buffer_overwrites_the_oldest_entry():
+    cache = qh.SemanticCache(max_entries=2)
+    vecs = [unit(i) for i in range(3)]
+    for i, v in enumerate(vecs):
+        put(cache, v, f"answer-{i}")
+
+    assert cache.get(vecs[0]) is None
+    assert cache.get(vecs[1]) == ("answer-1", [])
+    assert cache.get(vecs[2]) == ("answer-2", [])
+
+
+@pytest.mark.skipif(qh.faiss is None, reason="faiss not installed")
+def test_hnsw_probe_skips_stale_ids_and_rebuilds(monkeypatch):
+    monkeypatch.setattr(qh, "ANN_MIN_ENTRIES", 4)
+    cache = qh.SemanticCache(max_entries=4)
+    assert cache.ann is not None
+
+    vecs = [unit(i) for i in range(11)]
+    for i, v in enumerate(vecs):
+        put(cache, v, f"answer-{i}")
+
+    # 11 inserts into 4 slots: the graph was rebuilt at 8 ids and only holds live + newer rows
+    assert cache.ann.ntotal < 2 * cache.max_entries
+    for i in range(7):
+        assert cache.get(vecs[i]) is None
+    for i in range(7, 11):
+        assert cache.get(vecs[i]) == (f"answer-{i}", [])